@@ -1,10 +1,24 @@
 import sys
 import os
 import base64
+import hashlib
+import io
+import json
+import mimetypes
+import queue
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import orjson
 import requests
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Request, Response, abort, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -14,13 +28,47 @@ try:
 except Exception:
     pass
 
+class OrjsonProvider(JSONProvider):
+    """jsonify() backed by orjson; much faster on large base64/prediction payloads."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class InMemoryUploadRequest(Request):
+    """Keep uploaded files in memory instead of spooling large ones to a temp file.
+
+    Uploads are capped by MAX_CONTENT_LENGTH and read fully anyway, so the
+    default disk round-trip for files over 500 KB buys nothing here.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
-CORS(app)  # Enable CORS for Flutter calls
+app.request_class = InMemoryUploadRequest
+app.json = OrjsonProvider(app)
 # Limit upload size (10 MB)
 app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
 # Make Flask aware of Railway proxy so scheme/host are correct
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Enable CORS for Flutter calls: fixed headers, no per-request origin matching.
+# Preflight OPTIONS requests are answered by Flask's automatic OPTIONS handling;
+# as flask-cors did, allow whichever request headers the preflight asks for.
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+}
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers.update(CORS_HEADERS)
+    requested_headers = request.headers.get("Access-Control-Request-Headers")
+    if request.method == "OPTIONS" and requested_headers:
+        response.headers["Access-Control-Allow-Headers"] = requested_headers
+    return response
+
 # -------- Roboflow API Configuration --------
 ROBOFLOW_API_URL = os.getenv(
     "ROBOFLOW_API_URL",
@@ -29,16 +77,246 @@ ROBOFLOW_API_URL = os.getenv(
 # IMPORTANT: set this in Railway → Variables; default is a placeholder
 ROBOFLOW_API_KEY = os.getenv("ROBOFLOW_API_KEY", "REPLACE_ME")
 
+ROBOFLOW_TIMEOUT = (10, 60)  # 10s connect, 60s read
+ROBOFLOW_RETRIES = 3
+
+# Shared session so connections (and TLS) to Roboflow are kept alive and reused
+# (also over plain http, e.g. a self-hosted inference server on localhost:9001)
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    # inference is safe to repeat, so POST is retried on connect and gateway
+    # errors; read timeouts are not retried so a hung call fails after one wait
+    max_retries=Retry(
+        total=ROBOFLOW_RETRIES,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False,
+    ),
+)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+# -------- Request micro-batching --------
+# Images arriving within MAX_DELAY_MS of each other are sent to the workflow
+# as one batch of up to BATCH_SIZE images (BATCH_SIZE=1 disables batching)
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))
+MAX_DELAY_MS = int(os.getenv("MAX_DELAY_MS", "50"))
+# Backstop for a request waiting on its batch (e.g. if the dispatcher thread
+# died): the worst case of one workflow call with all adapter retries used
+BATCH_RESULT_TIMEOUT_SEC = int(os.getenv(
+    "BATCH_RESULT_TIMEOUT_SEC", str((ROBOFLOW_RETRIES + 1) * sum(ROBOFLOW_TIMEOUT) + 5)
+))
+
+class RoboflowError(Exception):
+    """Roboflow call failed; ``body``/``status`` are what the API returns.
+
+    ``input_error`` marks failures caused by the submitted images (a 4xx
+    answer, or outputs not matching the inputs) rather than by Roboflow itself.
+    """
+    def __init__(self, body, status=502, input_error=False):
+        super().__init__(body.get("error"))
+        self.body = body
+        self.status = status
+        self.input_error = input_error
+
+def run_workflow(encoded_images):
+    """Run the workflow on a list of base64-encoded images, one output per image."""
+    # The workflow endpoint only takes JSON with base64 inputs. The base64
+    # alphabet needs no JSON escaping, so splice the encoded bytes into the
+    # body directly rather than decoding to str and re-serializing it.
+    payload = b"".join((
+        b'{"api_key": ', json.dumps(ROBOFLOW_API_KEY).encode("utf-8"),
+        b', "inputs": {"image": [{"type": "base64", "value": "',
+        b'"}, {"type": "base64", "value": "'.join(encoded_images),
+        b'"}]}}',
+    ))
+
+    try:
+        rf_resp = _session.post(
+            ROBOFLOW_API_URL,
+            data=payload,
+            headers={"Content-Type": "application/json"},
+            timeout=ROBOFLOW_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        raise RoboflowError({"error": f"Roboflow request failed: {e}"})
+
+    if rf_resp.status_code != 200:
+        # Return Roboflow message to help debugging
+        try:
+            msg = rf_resp.json()
+        except Exception:
+            msg = rf_resp.text[:500]
+        raise RoboflowError(
+            {"error": "Roboflow error", "status": rf_resp.status_code, "message": msg},
+            input_error=400 <= rf_resp.status_code < 500,
+        )
+
+    try:
+        data = rf_resp.json()  # expect { outputs: [ { output_image: {...}, predictions: {...} }, ... ] }
+    except Exception as e:
+        raise RoboflowError({"error": f"Error processing Roboflow response: {e}"}, 500)
+    outputs = data.get("outputs", []) if isinstance(data, dict) else None
+    if not outputs or not isinstance(outputs, list) or len(outputs) != len(encoded_images):
+        raise RoboflowError({"error": "Unexpected Roboflow response: outputs missing"}, input_error=True)
+    return outputs
+
+class BatchDispatcher(threading.Thread):
+    """Background thread that coalesces concurrent images into workflow batches."""
+
+    def __init__(self, batch_size, max_delay_ms):
+        super().__init__(name="roboflow-batcher", daemon=True)
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self._queue = queue.Queue()
+        # batches are sent from a pool so collecting the next one never waits on Roboflow
+        self._senders = ThreadPoolExecutor(max_workers=32, thread_name_prefix="roboflow-send")
+
+    def submit(self, encoded_image):
+        """Queue one image and block until its workflow output is available."""
+        future = Future()
+        self._queue.put((encoded_image, future))
+        try:
+            return future.result(timeout=BATCH_RESULT_TIMEOUT_SEC)
+        except FutureTimeoutError:
+            raise RoboflowError({"error": "Timed out waiting for Roboflow"}, 504)
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            outputs = run_workflow([encoded for encoded, _ in batch])
+        except RoboflowError as e:
+            if e.input_error and len(batch) > 1:
+                # one bad image fails the whole call: resend each image on its own
+                # so the rest still succeed and each caller only sees its own error.
+                # Outages (connection errors, 5xx) are not split, so a failing
+                # Roboflow isn't hit with N more large requests.
+                for item in batch:
+                    self._senders.submit(self._send, [item])
+            else:
+                for _, future in batch:
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), output in zip(batch, outputs):
+            future.set_result(output)
+
+_dispatcher = None
+if BATCH_SIZE > 1:
+    _dispatcher = BatchDispatcher(BATCH_SIZE, MAX_DELAY_MS)
+    _dispatcher.start()
+
 # -------- Storage for processed images --------
 # On Railway, /tmp is a safe writable location
 PROCESSED_FOLDER = os.getenv("PROCESSED_FOLDER", "/tmp/processed")
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 app.config["PROCESSED_FOLDER"] = PROCESSED_FOLDER
 
+# Processed images older than PROCESSED_TTL_SEC are deleted by a background
+# reaper every PROCESSED_REAP_INTERVAL_SEC so /tmp doesn't grow without bound
+# (either one set to 0 or less disables the reaper)
+PROCESSED_TTL_SEC = int(os.getenv("PROCESSED_TTL_SEC", "3600"))
+PROCESSED_REAP_INTERVAL_SEC = int(os.getenv("PROCESSED_REAP_INTERVAL_SEC", "300"))
+
+def reap_processed():
+    while True:
+        cutoff = time.time() - PROCESSED_TTL_SEC
+        try:
+            with os.scandir(PROCESSED_FOLDER) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < cutoff:
+                            os.unlink(entry.path)
+                    except OSError:
+                        pass  # already removed (e.g. by another worker's reaper)
+        except OSError:
+            pass
+        time.sleep(PROCESSED_REAP_INTERVAL_SEC)
+
+if PROCESSED_TTL_SEC > 0 and PROCESSED_REAP_INTERVAL_SEC > 0:
+    threading.Thread(target=reap_processed, name="processed-reaper", daemon=True).start()
+
+def write_processed_file(filename, write):
+    """Create PROCESSED_FOLDER/filename atomically; ``write`` fills the open file.
+
+    Identical uploads share a processed filename, so the image is written to a
+    temp file and renamed into place: a concurrent request for the same image
+    never truncates, and readers never see, a half-written file.
+    """
+    folder = app.config["PROCESSED_FOLDER"]
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            write(out)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600; a fronting proxy must read it
+        os.replace(tmp_path, os.path.join(folder, filename))
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# When a reverse proxy fronts the app, let it stream processed images itself
+# instead of tying up a worker. For nginx set PROCESSED_ACCEL_PREFIX and add:
+#   location /_internal_processed/ { internal; alias /tmp/processed/; }
+# where the alias must match PROCESSED_FOLDER (otherwise nginx answers 404).
+# USE_X_SENDFILE=true does the same for proxies that honour X-Sendfile.
+PROCESSED_ACCEL_PREFIX = os.getenv("PROCESSED_ACCEL_PREFIX", "")  # e.g. /_internal_processed/
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE", "false").lower() == "true"
+
+# -------- Result cache --------
+# Repeated uploads of the same image (e.g. mobile retries) are answered from
+# memory, keyed by a hash of the image bytes, instead of re-running the workflow
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "512"))
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+def cache_get(digest):
+    with _result_cache_lock:
+        entry = _result_cache.get(digest)
+        if entry is not None:
+            _result_cache.move_to_end(digest)
+        return entry
+
+def cache_put(digest, entry):
+    if RESULT_CACHE_SIZE <= 0:
+        return
+    with _result_cache_lock:
+        _result_cache[digest] = entry
+        _result_cache.move_to_end(digest)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
 # -------- File validation --------
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+_ALLOWED_SUFFIXES = (".png", ".jpg", ".jpeg")
 def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(_ALLOWED_SUFFIXES)
+
+# Leading bytes of real JPEG / PNG files; anything else would only fail at Roboflow
+_IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")
+def looks_like_image(data: bytes) -> bool:
+    return data.startswith(_IMAGE_SIGNATURES)
 
 @app.get("/")
 def home():
@@ -52,8 +330,37 @@ def health():
 
 @app.get("/processed/<path:filename>")
 def serve_processed(filename):
+    if PROCESSED_ACCEL_PREFIX:
+        if safe_join(app.config["PROCESSED_FOLDER"], filename) is None:
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        # re-encode the decoded path so "?", "%" or non-ASCII names survive the header
+        accel_path = f"{PROCESSED_ACCEL_PREFIX.rstrip('/')}/{quote(filename)}"
+        return Response(mimetype=mimetype, headers={"X-Accel-Redirect": accel_path})
     return send_from_directory(app.config["PROCESSED_FOLDER"], filename)
 
+def build_detect_response(entry, include_b64, processed_image_base64=None):
+    """JSON response for a detection result (fresh or cached)."""
+    # ---- build absolute URL with correct scheme behind Railway proxy
+    scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
+    processed_image_url = f"{scheme}://{request.host}/processed/{entry['processed_filename']}"
+
+    resp_payload = {
+        "processed_image_url": processed_image_url,
+        "detected_ingredients": entry["detected_ingredients"],
+        "ingredients": entry["ingredients"],
+        "details": entry["details"],
+        "result": entry["result"],
+    }
+    if include_b64:
+        if processed_image_base64 is None and entry["has_output_image"]:
+            path = os.path.join(app.config["PROCESSED_FOLDER"], entry["processed_filename"])
+            with open(path, "rb") as f:
+                processed_image_base64 = base64.b64encode(f.read()).decode("ascii")
+        resp_payload["processed_image_base64"] = processed_image_base64
+
+    return jsonify(resp_payload), 200
+
 @app.post("/api/detect")
 def detect_image():
     # ---- validations
@@ -68,56 +375,55 @@ def detect_image():
     if not allowed_file(image_file.filename):
         return jsonify({"error": "Unsupported file format. Use PNG/JPG."}), 400
 
-    # Optional: return base64 in response? (default true for compatibility)
-    include_b64 = (request.args.get("include_base64", "true").lower() != "false")
+    # Optional: also return the processed image inline as base64? The image is
+    # always available at processed_image_url, so this is opt-in.
+    include_b64 = request.args.get("include_base64", "false").lower() == "true"
 
     # ---- read file to memory
     filename = secure_filename(image_file.filename)
     try:
         file_bytes = image_file.read()
-        base64_image = base64.b64encode(file_bytes).decode("utf-8")
     except Exception as e:
         return jsonify({"error": f"Failed to read image: {e}"}), 500
+    if not looks_like_image(file_bytes):
+        return jsonify({"error": "File content is not a PNG/JPG image."}), 400
+    digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
-    # ---- call Roboflow workflow
-    payload = {
-        "api_key": ROBOFLOW_API_KEY,
-        "inputs": {
-            "image": {"type": "base64", "value": base64_image}
-        },
-    }
+    # ---- same image seen recently: reuse its result
+    cached = cache_get(digest)
+    if cached is not None:
+        try:
+            # touch the processed image so the reaper keeps it while it's still in use
+            os.utime(os.path.join(app.config["PROCESSED_FOLDER"], cached["processed_filename"]))
+            return build_detect_response(cached, include_b64)
+        except OSError:
+            pass  # processed image was reaped; run the workflow again
 
-    try:
-        rf_resp = requests.post(
-            ROBOFLOW_API_URL,
-            json=payload,
-            timeout=(10, 60),  # 10s connect, 60s read
-        )
-    except requests.RequestException as e:
-        return jsonify({"error": f"Roboflow request failed: {e}"}), 502
+    base64_image = base64.b64encode(file_bytes)
+    del file_bytes  # the fallback write below goes through image_file.stream instead
 
-    if rf_resp.status_code != 200:
-        # Return Roboflow message to help debugging
-        try:
-            msg = rf_resp.json()
-        except Exception:
-            msg = rf_resp.text[:500]
-        return jsonify({"error": "Roboflow error", "status": rf_resp.status_code, "message": msg}), 502
+    # ---- call Roboflow workflow
+    try:
+        if _dispatcher is not None:
+            first_output = _dispatcher.submit(base64_image)
+        else:
+            first_output = run_workflow([base64_image])[0]
+    except RoboflowError as e:
+        return jsonify(e.body), e.status
+    del base64_image
 
     # ---- parse Roboflow response
     try:
-        data = rf_resp.json()  # expect { outputs: [ { output_image: {...}, predictions: {...} } ] }
-        outputs = data.get("outputs", [])
-        if not outputs or not isinstance(outputs, list):
-            return jsonify({"error": "Unexpected Roboflow response: outputs missing"}), 502
-
-        first_output = outputs[0]
-
-        # Output image (base64) from workflow
+        # Output image (base64) from workflow: decode it once for the disk write
+        # and only keep the multi-MB string alive if the client wants it inline
         processed_image_base64 = None
-        out_img = first_output.get("output_image")
-        if isinstance(out_img, dict):
-            processed_image_base64 = out_img.get("value")
+        processed_image_bytes = None
+        out_img = first_output.pop("output_image", None)
+        if isinstance(out_img, dict) and out_img.get("value"):
+            processed_image_bytes = base64.b64decode(out_img["value"])
+            if include_b64:
+                processed_image_base64 = out_img["value"]
+        del out_img
 
         # Predictions may be nested: predictions: { predictions: [...] }
         predictions_block = first_output.get("predictions", {})
@@ -129,36 +435,38 @@ def detect_image():
             predictions = predictions_block
 
         # Count per class + uniq list for convenience
-        class_counts = {}
-        for obj in predictions or []:
-            if isinstance(obj, dict):
-                cls = obj.get("class", "Unknown")
-                class_counts[cls] = class_counts.get(cls, 0) + 1
-
-        detected_ingredients = sorted(list(class_counts.keys()))
-        details = [{"class": c, "count": n} for c, n in class_counts.items()]
+        class_counts = Counter(
+            obj.get("class", "Unknown") for obj in predictions or [] if isinstance(obj, dict)
+        )
+
+        detected_ingredients = sorted(class_counts)
+        details = [{"class": c, "count": n} for c, n in class_counts.most_common()]
         total_ingredients = sum(class_counts.values())
 
         # ---- save processed image (if provided)
-        processed_filename = f"processed_{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}_{filename}"
-        if processed_image_base64:
+        processed_filename = f"processed_{digest[:16]}_{filename}"
+        if processed_image_bytes is not None:
             try:
-                with open(os.path.join(app.config["PROCESSED_FOLDER"], processed_filename), "wb") as out:
-                    out.write(base64.b64decode(processed_image_base64))
+                write_processed_file(processed_filename, lambda out: out.write(processed_image_bytes))
             except Exception as e:
                 return jsonify({"error": f"Failed to write processed image: {e}"}), 500
         else:
             # fallback: store the original if workflow didn't return an image
+            def write_upload(out):
+                if isinstance(image_file.stream, io.BytesIO):
+                    # InMemoryUploadRequest keeps uploads in a BytesIO: write its
+                    # buffer directly rather than copying it out in chunks
+                    with image_file.stream.getbuffer() as upload:
+                        out.write(upload)
+                else:
+                    image_file.stream.seek(0)
+                    image_file.save(out)
+
             try:
-                with open(os.path.join(app.config["PROCESSED_FOLDER"], processed_filename), "wb") as out:
-                    out.write(file_bytes)
+                write_processed_file(processed_filename, write_upload)
             except Exception as e:
                 return jsonify({"error": f"Failed to write fallback image: {e}"}), 500
 
-        # ---- build absolute URL with correct scheme behind Railway proxy
-        scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
-        processed_image_url = f"{scheme}://{request.host}/processed/{processed_filename}"
-
         # ---- compatibility 'result' field (string for single class, dict otherwise)
         if len(class_counts) == 1:
             only = next(iter(class_counts))
@@ -166,20 +474,21 @@ def detect_image():
         else:
             result = {"ingredients": total_ingredients, "details": details}
 
-        resp_payload = {
-            "processed_image_url": processed_image_url,
+        entry = {
+            "processed_filename": processed_filename,
+            "has_output_image": processed_image_bytes is not None,
             "detected_ingredients": detected_ingredients,
             "ingredients": total_ingredients,
             "details": details,
             "result": result,
         }
-        if include_b64:
-            resp_payload["processed_image_base64"] = processed_image_base64
+        cache_put(digest, entry)
 
-        return jsonify(resp_payload), 200
+        return build_detect_response(entry, include_b64, processed_image_base64)
 
     except Exception as e:
         return jsonify({"error": f"Error processing Roboflow response: {e}"}), 500
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    # local development only; production runs under gunicorn (see Procfile)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
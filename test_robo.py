@@ -0,0 +1,97 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+os.environ.setdefault("ROBOFLOW_API_KEY", "test-key")
+os.environ.setdefault("PROCESSED_FOLDER", tempfile.mkdtemp())
+os.environ.setdefault("PROCESSED_TTL_SEC", "0")
+os.environ.setdefault("BATCH_SIZE", "1")
+
+import requests
+
+import robo
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self._body
+
+
+class BatchDispatcherTest(unittest.TestCase):
+    """BatchDispatcher against a fake Roboflow that echoes each image back."""
+
+    outage = False
+
+    def setUp(self):
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        self.original_post = robo._session.post
+        robo._session.post = self.fake_post
+        self.dispatcher = robo.BatchDispatcher(batch_size=4, max_delay_ms=200)
+        self.dispatcher.start()
+
+    def tearDown(self):
+        robo._session.post = self.original_post
+
+    def fake_post(self, url, data=None, **kwargs):
+        images = [base64.b64decode(i["value"]).decode() for i in json.loads(data)["inputs"]["image"]]
+        with self.calls_lock:
+            self.calls.append(images)
+        if self.outage:
+            raise requests.ConnectionError("connection refused")
+        if "bad" in images:
+            return FakeResponse(400, {"message": "bad image"})
+        return FakeResponse(200, {"outputs": [{"echo": image} for image in images]})
+
+    def submit_concurrently(self, names):
+        results = {}
+
+        def worker(name):
+            try:
+                results[name] = self.dispatcher.submit(base64.b64encode(name.encode()))
+            except robo.RoboflowError as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=worker, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_outputs_map_back_to_their_callers(self):
+        results = self.submit_concurrently(["a", "b", "c", "d"])
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(self.calls[0]), ["a", "b", "c", "d"])
+        for name, output in results.items():
+            self.assertEqual(output, {"echo": name})
+
+    def test_bad_image_fails_only_its_own_request(self):
+        results = self.submit_concurrently(["a", "bad", "c", "d"])
+
+        self.assertIsInstance(results["bad"], robo.RoboflowError)
+        self.assertEqual(results["bad"].body["status"], 400)
+        for name in ("a", "c", "d"):
+            self.assertEqual(results[name], {"echo": name})
+
+    def test_outage_fails_whole_batch_without_resending(self):
+        self.outage = True
+        results = self.submit_concurrently(["a", "b", "c", "d"])
+
+        self.assertEqual(len(self.calls), 1)
+        for error in results.values():
+            self.assertIsInstance(error, robo.RoboflowError)
+            self.assertIn("connection refused", error.body["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()